@@ -12,9 +12,15 @@ db = tinydb.TinyDB(op.join(CACHE_DIR,'cache.json'),
                            indent=2,
                            ensure_ascii=False)
 
+# Messages are kept in a file of their own, since they make up most of the cache.
+msg_db = tinydb.TinyDB(op.join(CACHE_DIR,'messages.json'),
+                               encoding='utf-8',
+                               indent=2,
+                               ensure_ascii=False)
+
 channels = db.table('channels')
-cache = db.table('message_cache')
-users = db.table('users')
+messages = msg_db.table('reacted_messages')
+members = db.table('members')
 emoji = db.table('emoji')
 
 Msg = tinydb.Query()
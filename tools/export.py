@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+""" Export the voobot cache to flat files for offline analysis.
+
+    Each entity gets its own file in the output directory:
+        - messages:   id, author, channel, datetime
+        - reacts:     message, channel, emoji, user   (one row per reaction)
+        - emoji:      id, name, custom, url, discord_str, created_at
+        - members:    id, name, discriminator, nick, guild, left
+        - channels:   id, name, guild, sentinel_datetime
+
+    The cache files are streamed one record at a time, and rows are written out
+    in fixed-size batches, so memory use stays bounded however large the cache is.
+
+    With --since-last, only messages that may have changed since the previous
+    export into the same directory are written. These land in a new timestamped
+    subdirectory. Consumers should keep the newest row for each message id, and
+    whenever a message is re-exported, replace *all* of its rows in `reacts`
+    with the new run's (reaction rows have no key of their own, and reactions
+    may have been removed as well as added).
+
+    Usage:
+        python tools/export.py out/ --format csv
+        python tools/export.py out/ --format parquet --since-last
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import itertools
+import os
+from os import path as op
+import sys
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+from voobot.jsonstream import stream_tables
+
+CACHE_DIR = 'cache'
+CACHE_FILES = ['cache.json', 'messages.json']
+STATE_FILE = 'export_state.json'
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+RUN_DIR_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+BATCH_SIZE = 10000
+
+# Column names and types for each exported entity.
+# Unicode emoji ids are packed code points, which can overflow an int64.
+COLUMNS = {
+    'messages': [('id', int), ('author', int), ('channel', int), ('datetime', str)],
+    'reacts':   [('message', int), ('channel', int), ('emoji', str), ('user', int)],
+    'emoji':    [('id', str), ('name', str), ('custom', bool), ('url', str),
+                 ('discord_str', str), ('created_at', str)],
+    'members':  [('id', int), ('name', str), ('discriminator', str), ('nick', str),
+                 ('guild', int), ('left', bool)],
+    'channels': [('id', int), ('name', str), ('guild', int), ('sentinel_datetime', str)],
+}
+
+# Maps cache table names to the entity they are exported as.
+TABLES = {
+    'reacted_messages': 'messages',
+    'emoji':            'emoji',
+    'members':          'members',
+    'channels':         'channels',
+}
+
+###########################################################
+##                     Writers
+###########################################################
+
+class CsvWriter():
+    def __init__(self, path, columns):
+        self.columns = [name for name, _ in columns]
+        self.f = open(path + '.csv', 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(self.columns)
+
+    def write(self, rows):
+        self.writer.writerows([[row.get(c) for c in self.columns] for row in rows])
+
+    def close(self):
+        self.f.close()
+
+class ArrowWriter():
+    """ Writes Parquet or Arrow IPC files. Requires pyarrow. """
+
+    def __init__(self, path, columns, fmt):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit(f'pyarrow is required for --format {fmt} (pip install pyarrow)')
+        types = {int: pyarrow.int64(), str: pyarrow.string(), bool: pyarrow.bool_()}
+        self.pa = pyarrow
+        self.columns = columns
+        self.schema = pyarrow.schema([(name, types[t]) for name, t in columns])
+
+        path = f'{path}.{fmt}'
+        if fmt == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        def convert(v, t):
+            return v if v is None else t(v)
+        batch = self.pa.Table.from_pydict(
+            {name: [convert(row.get(name), t) for row in rows] for name, t in self.columns},
+            schema=self.schema)
+        self.writer.write_table(batch)
+
+    def close(self):
+        self.writer.close()
+
+class BatchedWriter():
+    """ Buffers rows for a single entity, and flushes them in batches. """
+
+    def __init__(self, out_dir, entity, fmt, batch_size=BATCH_SIZE):
+        path = op.join(out_dir, entity)
+        columns = COLUMNS[entity]
+        if fmt == 'csv':
+            self.writer = CsvWriter(path, columns)
+        else:
+            self.writer = ArrowWriter(path, columns, fmt)
+        self.batch_size = batch_size
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write(self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+###########################################################
+##                      Export
+###########################################################
+
+def load_state(out_dir):
+    """ Return the state saved by the last export into out_dir, if any. """
+    try:
+        with open(op.join(out_dir, STATE_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_state(out_dir, state):
+    tmp_path = op.join(out_dir, STATE_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, op.join(out_dir, STATE_FILE))
+
+def make_run_dir(out_dir):
+    """ Create and return a new, uniquely named subdirectory for this run. """
+    base = op.join(out_dir, datetime.datetime.now().strftime(RUN_DIR_FORMAT))
+    run_dir, n = base, 1
+    while True:
+        try:
+            os.makedirs(run_dir)
+            return run_dir
+        except FileExistsError:
+            run_dir = f'{base}-{n}'
+            n += 1
+
+def stream_cache(cache_dir):
+    """ Yield (table, record) pairs from all of the cache files in cache_dir. """
+    paths = [op.join(cache_dir, name) for name in CACHE_FILES]
+    return itertools.chain.from_iterable(stream_tables(p) for p in paths if op.exists(p))
+
+def read_sentinels(cache_dir):
+    """ Map each channel id to its current sentinel datetime string. """
+    return {str(rec['id']): rec.get('sentinel_datetime')
+            for table, rec in stream_cache(cache_dir) if table == 'channels'}
+
+def export(cache_dir, out_dir, fmt, since_last=False):
+    """ Export the cache in cache_dir into out_dir.
+
+        Messages sent before a channel's sentinel are final, and will never be
+        changed by the bot again. So an incremental export only needs messages
+        after the sentinels recorded by the previous export; anything earlier
+        has already been written out in its final state.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Messages after the sentinels we record now might still change, so the
+    # next incremental run has to pick up from here.
+    sentinels = read_sentinels(cache_dir)
+
+    since = None
+    run_dir = out_dir
+    if since_last:
+        state = load_state(out_dir)
+        if state is not None:
+            since = state['sentinels']
+            run_dir = make_run_dir(out_dir)
+
+    def is_new(msg):
+        if since is None:
+            return True
+        channel_since = since.get(str(msg['channel']))
+        # Compare as strings; DATETIME_FORMAT sorts chronologically.
+        return not channel_since or msg['datetime'] >= channel_since
+
+    writers = {entity: BatchedWriter(run_dir, entity, fmt) for entity in COLUMNS}
+    try:
+        for table, rec in stream_cache(cache_dir):
+            entity = TABLES.get(table)
+            if entity is None:
+                continue
+            if entity == 'messages':
+                if not is_new(rec):
+                    continue
+                for emoji, reactors in rec.get('reacts', {}).items():
+                    for user in reactors:
+                        writers['reacts'].add({
+                            'message':  rec['id'],
+                            'channel':  rec['channel'],
+                            'emoji':    emoji,
+                            'user':     user,
+                        })
+            writers[entity].add(rec)
+    finally:
+        for w in writers.values():
+            w.close()
+
+    save_state(out_dir, {
+        'exported_at': datetime.datetime.now().strftime(DATETIME_FORMAT),
+        'sentinels': sentinels,
+    })
+
+    for entity, w in writers.items():
+        print(f'{entity:10s} {w.count} rows')
+    print(f'Exported to {run_dir}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the voobot cache for offline analysis.')
+    parser.add_argument('out_dir', help='Directory to write the exported files to.')
+    parser.add_argument('--format', choices=['csv', 'parquet', 'arrow'], default='csv')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help='Directory holding the cache files to export.')
+    parser.add_argument('--since-last', action='store_true',
+                        help='Only export messages that may have changed since the last export.')
+    args = parser.parse_args()
+
+    export(args.cache_dir, args.out_dir, args.format, since_last=args.since_last)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+""" Compare the memory used by the message cache as plain dicts (as loaded by
+    TinyDB) against the compact MessageStore, on synthetic data.
+
+    Also compares the peak memory of loading a MessageStore from a cache file
+    by parsing the whole file, against streaming it in one record at a time.
+
+    Usage:
+        python tools/membench.py [num_messages]
+"""
+
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from os import path as op
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+from voobot.jsonstream import stream_tables
+from voobot.messagestore import MessageStore, DATETIME_FORMAT
+
+EMOJI = ['👍', '👎', '😂', '❤️', '🦍', '🍓'] + [f'<:custom{i}:{10**17 + i}>' for i in range(50)]
+
+def fake_messages(n, seed=0):
+    """ Generate n message records shaped like those in the cache. """
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    users = [rng.randrange(10**17, 10**18) for _ in range(500)]
+    channels = [rng.randrange(10**17, 10**18) for _ in range(20)]
+    for i in range(n):
+        reacts = {e: rng.sample(users, rng.randint(1, 8))
+                  for e in rng.sample(EMOJI, rng.randint(1, 4))}
+        yield {
+            'id':       10**18 + i,
+            'author':   rng.choice(users),
+            'channel':  rng.choice(channels),
+            'datetime': (start + datetime.timedelta(seconds=60 * i)).strftime(DATETIME_FORMAT),
+            'reacts':   reacts,
+        }
+
+def measure(build):
+    """ Return (result, bytes allocated by build()). """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def measure_peak(build):
+    """ Return the peak number of bytes allocated while running build(). """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    build()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - before
+
+def write_cache_file(path, messages):
+    """ Write the given message records to path, laid out as TinyDB would. """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'reacted_messages': {str(i): msg for i, msg in enumerate(messages, 1)}},
+                  f, indent=2, ensure_ascii=False)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    # Round-trip through JSON so the dicts don't share objects, as when loaded from disk.
+    raw = json.dumps(list(fake_messages(n)), ensure_ascii=False)
+    num_reactions = sum(len(r) for msg in json.loads(raw) for r in msg['reacts'].values())
+
+    _, dict_bytes = measure(lambda: json.loads(raw))
+
+    def build_store():
+        store = MessageStore()
+        store.extend(json.loads(raw))
+        return store
+    store, store_bytes = measure(build_store)
+
+    print(f'{n} messages, {num_reactions} reactions')
+    print(f'  dicts:        {dict_bytes / num_reactions:8.1f} bytes/reaction  ({dict_bytes / 2**20:.1f} MiB)')
+    print(f'  MessageStore: {store_bytes / num_reactions:8.1f} bytes/reaction  ({store_bytes / 2**20:.1f} MiB)')
+    print(f'                ({store.nbytes() / num_reactions:.1f} bytes/reaction in arrays)')
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        write_cache_file(path, json.loads(raw))
+        del raw
+
+        def load_parsed():
+            with open(path, encoding='utf-8') as f:
+                messages = json.load(f)['reacted_messages'].values()
+            MessageStore().extend(messages)
+        def load_streamed():
+            MessageStore().extend(rec for table, rec in stream_tables(path)
+                                  if table == 'reacted_messages')
+        parsed_peak = measure_peak(load_parsed)
+        streamed_peak = measure_peak(load_streamed)
+    finally:
+        os.remove(path)
+
+    print(f'Peak while loading the store from a file of {n} messages:')
+    print(f'  parsed:       {parsed_peak / 2**20:8.1f} MiB')
+    print(f'  streamed:     {streamed_peak / 2**20:8.1f} MiB')
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,26 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 import tinydb
-from tinydb import operations as dbops
 
 import asyncio
 import datetime
-from collections import deque
+from collections import Counter, defaultdict, deque
 import functools
+import json
 import logging
+import math
 import operator
 import os
 import time
 
 from . import progressbar # Imported for its constants (TYPING, ...)
+from .concurrency import SingleFlight
+from .jsonstream import stream_tables
+from .lateness import LatenessHistogram
+from .messagestore import MessageStore, dt_to_micros
+from .paging import PREV_PAGE, NEXT_PAGE # Paging controls, not real reactions
+from .querytrace import QueryTrace
 
 logger = logging.getLogger(__name__)
 
@@ -22,10 +29,54 @@ logger = logging.getLogger(__name__)
 ###########################################################
 
 CACHE_DIR = 'cache'
+CACHE_FILE = 'cache.json'
+MESSAGES_FILE = 'messages.json' # Messages are most of the cache, so they get their own file
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 YMD_FORMAT = '%Y-%m-%d'
 
+# Default rescan window, used until a channel has enough lateness samples.
+DEFAULT_LOOKBACK_NUM = 250
+DEFAULT_LOOKBACK_TIME = datetime.timedelta(days=7)
+
+# Once a channel has at least LATENESS_MIN_SAMPLES observed reaction changes,
+# its rescan window is sized to cover the LATENESS_QUANTILE of their lateness,
+# clamped to [MIN_LOOKBACK_TIME, MAX_LOOKBACK_TIME]. A handful of the most
+# recent messages are always rescanned too.
+LATENESS_MIN_SAMPLES = 200
+LATENESS_QUANTILE = 0.99
+ADAPTIVE_LOOKBACK_NUM = 25
+MIN_LOOKBACK_TIME = datetime.timedelta(hours=1)
+MAX_LOOKBACK_TIME = datetime.timedelta(days=60)
+
+# How often lateness stats gathered from reaction events are written to disk.
+LATENESS_FLUSH_MINUTES = 10
+
+# Discord returns at most this many reactors per request.
+REACTORS_PER_REQUEST = 100
+
+# How many messages a query scans between yielding to the event loop.
+SCAN_BATCH_SIZE = 2000
+
+# Rough relative cost of evaluating each query directive against one message.
+# Cheaper filters are applied first, so the expensive ones see fewer messages.
+# ('by' and 'react' have to unpack the message's reacts.)
+DIRECTIVE_COSTS = {
+    'in': 0,
+    'msgby': 0,
+    'before': 1,
+    'after': 1,
+    'react': 2,
+    'by': 3,
+}
+
+# The name of the stage in which each directive's value is resolved.
+DIRECTIVE_STAGES = {
+    'in': 'channel lookup',
+    'by': 'member lookup',
+    'msgby': 'member lookup',
+}
+
 def dttos(dt, fmt=DATETIME_FORMAT):
     """ Convert the provided datetime to a string. """
     if dt is None:
@@ -61,7 +112,18 @@ class Cache(commands.Cog):
 
         # This assumes the bot will only ever run on one server.
         # It might work for several servers, but I haven't tested it.
-        self._db = tinydb.TinyDB(os.path.join(CACHE_DIR,'cache.json'),
+        self._db = tinydb.TinyDB(os.path.join(CACHE_DIR, CACHE_FILE),
+                                encoding='utf-8',
+                                indent=2,
+                                ensure_ascii=False)
+
+        # TinyDB parses its whole file on every table access, so messages live
+        # in a file of their own. Otherwise every channel or member lookup
+        # would also parse every cached message.
+        messages_path = os.path.join(CACHE_DIR, MESSAGES_FILE)
+        if not os.path.exists(messages_path):
+            self._split_messages_file(messages_path)
+        self._msg_db = tinydb.TinyDB(messages_path,
                                 encoding='utf-8',
                                 indent=2,
                                 ensure_ascii=False)
@@ -69,11 +131,69 @@ class Cache(commands.Cog):
         # Load DB tables from disk, or initialize them if they don't exist.
         # Note: the 'reacted_messages' table only caches messages with reactions.
         #       This may change in the future.
-        self._messages = self._db.table('reacted_messages')
+        self._messages = self._msg_db.table('reacted_messages')
         self._channels = self._db.table('channels')
         self._members = self._db.table('members')
         self._emoji = self._db.table('emoji')
 
+        # Queries run against a compact in-memory copy of the messages instead.
+        # It is streamed in one record at a time, so no dict of every message
+        # is ever built.
+        # Note: each message upsert during a rescan still has TinyDB parse (and
+        #       rewrite) all of messages.json, so rescans briefly peak at about
+        #       the size of the parsed file. Queries and startup don't.
+        self._store = MessageStore()
+        self._store.extend(rec for table, rec in stream_tables(messages_path)
+                           if table == 'reacted_messages')
+        logger.info(f'Loaded {len(self._store)} cached messages')
+
+        # Set while the startup catch-up scan is running.
+        self._catching_up = False
+
+        # Per channel id: the current sentinel, and observed reaction lateness.
+        channels = self._channels.all()
+        self._sentinels = {c['id']: stodt(c['sentinel_datetime']) for c in channels}
+        self._lateness = defaultdict(LatenessHistogram)
+        self._lateness.update({c['id']: LatenessHistogram.from_dict(c['lateness'])
+                               for c in channels if 'lateness' in c})
+        self._lateness_dirty = set() # Channel ids with unsaved lateness stats
+        self._flush_lateness_loop.start()
+
+        # In-flight rescans by guild id, and a lock per channel id.
+        self._rescans = SingleFlight()
+        self._channel_locks = defaultdict(asyncio.Lock)
+
+    def cog_unload(self):
+        self._flush_lateness_loop.cancel()
+        self._flush_lateness()
+
+    def _split_messages_file(self, messages_path):
+        """ Move the 'reacted_messages' table out of the main cache file,
+            where older versions kept it, into its own file.
+
+            Records are copied over one at a time. Only TinyDB itself parses the
+            old file in full, to check for and then drop the old table, once.
+        """
+        cache_path = os.path.join(CACHE_DIR, CACHE_FILE)
+        if 'reacted_messages' not in self._db.tables():
+            return
+
+        logger.info(f'Moving cached messages from {cache_path} to {messages_path}')
+        tmp_path = messages_path + '.tmp'
+        n = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('{"reacted_messages": {')
+            for table, rec in stream_tables(cache_path):
+                if table != 'reacted_messages':
+                    continue
+                n += 1
+                f.write(f'{"," if n > 1 else ""}\n"{n}": ')
+                f.write(json.dumps(rec, ensure_ascii=False))
+            f.write('\n}}')
+        os.replace(tmp_path, messages_path)
+        self._db.drop_table('reacted_messages')
+        logger.info(f'Moved {n} cached messages')
+
     def get_members_by_name(self, ctx, name: str):
         """
         Return a list of members belonging to the guild of the provided context,
@@ -86,14 +206,12 @@ class Cache(commands.Cog):
         Returns:
             - List[Discord.Member], the matching members
         """
-        # TODO: We don't invalidate member records, so weird things might
-        #       happen if we try to look up a member who's left the guild.
         Member = tinydb.Query()
 
         def contains_string(needle):
-            return lambda haystack: needle in haystack
+            return lambda haystack: haystack is not None and needle in haystack
 
-        guild_matches = Member.guild == ctx.guild.id
+        guild_matches = (Member.guild == ctx.guild.id) & ~(Member.left == True)
         name_matches = Member.name.test(contains_string(name))
         nick_matches = Member.nick.test(contains_string(name))
 
@@ -125,48 +243,173 @@ class Cache(commands.Cog):
             await ctx.message.delete()
             return
 
-        progress_msgs = ["Rescanning. This might take a while..."]
-        def progress_msg():
-            return "\n   >  ".join(progress_msgs)
+        # Only one rescan runs per guild; anyone else asking joins it.
+        if (running := self._rescans.join(ctx.guild.id)) is not None:
+            await ctx.send("A rescan is already running. I'll let you know when it's done!")
+            await running
+            await ctx.send(r"All done! \\(^_^)/")
+            return
 
-        logger.info('initiating rescan...')
-        msg = await ctx.send(progress_msg())
+        await self._rescans.do(ctx.guild.id, lambda: self._rescan_guild(ctx))
+
+    async def _rescan_guild(self, ctx):
+        """ Rescan the members and channels of the ctx's guild,
+            reporting progress in the ctx's channel. """
+        async with self.bot.admission.admit(ctx.author.id):
+            progress_msgs = ["Rescanning. This might take a while..."]
+            def progress_msg():
+                return "\n   >  ".join(progress_msgs)
+
+            logger.info('initiating rescan...')
+            msg = await ctx.send(progress_msg())
+
+            logger.info('scanning members...')
+            self._rescan_members(ctx.guild)
+
+            logger.info('scanning channels...')
+            with self.bot.progress_bar(msg, reacts=progressbar.TYPING):
+                # await asyncio.sleep(5)
+                scan_coros = [self._rescan_channel(ctx.guild, c) for c in ctx.guild.text_channels]
+                stats = sum(await asyncio.gather(*scan_coros), Counter())
+
+            logger.info(f'done rescan: {dict(stats)}')
+            progress_msgs.append(f"Skipped {stats['unchanged_msgs']} unchanged messages, "
+                                 f"saving {stats['reactor_calls_avoided']} API calls "
+                                 f"({stats['reactor_calls']} made)")
+            progress_msgs.append(r"All done! \\(^_^)/")
+            await msg.edit(content=progress_msg())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """ Catch up on any messages sent while the bot was offline. """
+        if self._catching_up:
+            return
+        self._catching_up = True
+        try:
+            await asyncio.gather(*[self._catch_up(guild) for guild in self.bot.guilds])
+        finally:
+            self._catching_up = False
 
-        logger.info('scanning members...')
-        self._rescan_members(ctx)
+    async def _catch_up(self, guild):
+        """ Incrementally rescan only those channels of the guild with new messages.
 
-        logger.info('scanning channels...')
-        with self.bot.progress_bar(msg, reacts=progressbar.TYPING):
-            # await asyncio.sleep(5)
-            scan_coros = [self._rescan_channel(ctx, c) for c in ctx.guild.text_channels]
-            await asyncio.gather(*scan_coros)
+            The guild payload sent on connect includes each channel's
+            `last_message_id`, so unchanged channels can be skipped by comparing
+            it to the last message id seen by the previous scan, without making
+            any API requests.
 
-        logger.info('done rescan')
-        progress_msgs.append(r"All done! \\(^_^)/")
-        await msg.edit(content=progress_msg())
+            Channels that have never been scanned are left for a full `rescan`.
 
-    def _rescan_members(self, ctx):
-        """ Rescan the members of the ctx's guild.
+            Members are synced too, since member events may have been missed.
+        """
+        self._rescan_members(guild)
 
-            NOTE: This rescan will update existing members, but will not flush
-                or invalidate members who have since left the guild.
+        Channel = tinydb.Query()
+        last_seen = {c['id']: c.get('last_message_id')
+                     for c in self._channels.search(Channel.guild == guild.id)}
+
+        changed = [c for c in guild.text_channels
+                   if c.id in last_seen and c.last_message_id != last_seen[c.id]]
+
+        logger.info(f'Catching up on {len(changed)} of {len(guild.text_channels)} '
+                    f'channels in {guild.name}')
+        await asyncio.gather(*[self._rescan_channel(guild, c) for c in changed])
+
+    def _rescan_members(self, guild):
+        """ Sync the cached members of the guild with its current member list.
+
+            The cache is diffed against the member list in a single pass, and
+            only the rows that changed are written back, in one batch per table
+            operation (rather than one full rewrite of the cache per member).
+
+            Members who have since left the guild are tombstoned ('left': True)
+            rather than deleted, so their ids still resolve in older messages.
+            This is skipped unless the guild's member list is complete
+            (`guild.chunked`); otherwise members who simply haven't been
+            loaded yet would be marked as departed.
         """
+        Member = tinydb.Query()
+        cached = {doc['id']: doc for doc in self._members.search(Member.guild == guild.id)}
+
+        new_records = []
+        changes = {}    # Maps member id -> the fields to update
+        doc_ids = []
+        for u in guild.members:
+            record = self._member_record(u)
+            doc = cached.pop(u.id, None)
+            if doc is None:
+                new_records.append(record)
+            elif any(doc.get(k) != v for k, v in record.items()):
+                changes[u.id] = record
+                doc_ids.append(doc.doc_id)
+
+        # Anyone still left in `cached` is no longer in the guild.
+        if guild.chunked:
+            for doc in cached.values():
+                if not doc.get('left'):
+                    changes[doc['id']] = {'left': True}
+                    doc_ids.append(doc.doc_id)
+        else:
+            logger.warning(f'Members of {guild.name} are not fully loaded '
+                           f'({len(guild.members)} of {guild.member_count}); '
+                           f'not checking for departed members')
+
+        if changes:
+            def apply_changes(doc):
+                doc.update(changes[doc['id']])
+            self._members.update(apply_changes, doc_ids=doc_ids)
+        if new_records:
+            self._members.insert_multiple(new_records)
+
+        departed = sum(1 for fields in changes.values() if fields.get('left'))
+        logger.info(f'Synced members of {guild.name}: {len(new_records)} new, '
+                    f'{len(changes) - departed} changed, {departed} departed')
+
+    def _member_record(self, member):
+        """ Return the cache record for the given `discord.Member`. """
+        return {
+            'id':               member.id,
+            'name':             member.name,
+            'discriminator':    member.discriminator,
+            'nick':             member.nick,
+            'guild':            member.guild.id,
+            'left':             False,
+        }
+
+    def _upsert_member(self, member, **fields):
+        """ Update the cache record of a single member with the given fields. """
+        Member = tinydb.Query()
+        self._members.upsert(dict(self._member_record(member), **fields),
+                             (Member.id == member.id) & (Member.guild == member.guild.id))
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self._upsert_member(member)
 
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self._upsert_member(member, left=True)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.nick != after.nick:
+            self._upsert_member(after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if (before.name, before.discriminator) == (after.name, after.discriminator):
+            return
         Member = tinydb.Query()
-        for u in ctx.guild.members:
-            self._members.upsert({
-                'id':               u.id,
-                'name':             u.name,
-                'discriminator':    u.discriminator,
-                'nick':             u.nick,
-                'guild':            ctx.guild.id,
-            }, Member.id == u.id)
+        self._members.update({
+            'name':             after.name,
+            'discriminator':    after.discriminator,
+        }, Member.id == after.id)
 
     async def _rescan_channel(self,
-                             ctx: discord.ext.commands.Context,
+                             guild: discord.Guild,
                              channel: discord.TextChannel,
-                             lookback_num=250,
-                             lookback_time=datetime.timedelta(days=7),
+                             lookback_num=None,
+                             lookback_time=None,
                              force_sentinel=None):
         """
         Rescan the given channel to populate the message cache with all previously
@@ -183,16 +426,27 @@ class Cache(commands.Cog):
         1) the datetime of the `lookback_num`'th most recent message in the channel, OR
         2) the datetime occurring `lookback_time` before the most recent message in the channel.
 
+        Unless given, `lookback_num` and `lookback_time` are chosen per channel
+        from the observed lateness of its reactions; see `_lookback`.
+
+        The sentinel never moves earlier than the previous one, since messages
+        before that were already treated as final. So when a channel's window
+        grows, its sentinel simply holds still until the window has caught up.
+
         WARNING: The sentinel is an imperfect heuristic; in particular it
                  assumes that messages will never be reacted to again once
                  they become old enough. (i.e. no "necro" reactions).
+                 How often this happens is tracked as the channel's miss rate.
 
         TODO: The rescan currently only detects reactions to messages.
               It will not detect messages that contain emoji in the body,
               although it would be nice to track these occurrences as well.
 
+        The id of the newest message seen is persisted alongside the sentinel,
+        so that channels without new messages can be skipped on startup.
+
         Args:
-            ctx: The context from which the rescan was requested.
+            guild: The guild the channel belongs to.
             channel: The channel to be rescanned.
             lookback_num: How many messages to look back for the next sentinel.
             lookback_time: How much time before the most recent message to look
@@ -201,96 +455,236 @@ class Cache(commands.Cog):
                             to this point in the past.
 
         Returns:
-            None
+            collections.Counter, with the number of requests made for reactor
+            lists ('reactor_calls'), the number avoided because a message's
+            reaction counts were unchanged ('reactor_calls_avoided'), and the
+            number of messages skipped entirely ('unchanged_msgs').
         """
-        start_time = time.time()
+        stats = Counter()
+
+        # Overlapping scans of one channel would race on its sentinel.
+        async with self._channel_locks[channel.id]:
+            start_time = time.time()
+
+            if not channel.permissions_for(guild.me).read_message_history:
+                logger.warning(f'Bot not permitted to read_message_history in {channel.name}')
+                return stats
+
+            # Find the last sentinel, if it exists
+            Channel = tinydb.Query()
+            sentinel_datetime = None
+            if channels := self._channels.search(Channel.id == channel.id):
+                if len(channels) != 1:
+                    logger.warning(f"Search for channel id {channel.id} expected 1 channel; yielded {channels}")
+                    return stats
+                sentinel_datetime = stodt(channels[0]['sentinel_datetime'])
+            previous_sentinel = sentinel_datetime
+
+            if force_sentinel is not None:
+                sentinel_datetime = force_sentinel
+
+            default_num, default_time = self._lookback(channel.id)
+            lookback_num = lookback_num or default_num
+            lookback_time = lookback_time or default_time
+
+            async def insert_message_record(msg, reactions):
+                """ Insert a `Message` record, with the given reactions, into the cache.
+
+                    Returns False (without writing anything) if the message's
+                    reactions are unchanged since it was last cached.
+                """
+                Message = tinydb.Query()
+
+                # `msg.reactions` already carries a count per emoji, so compare
+                # those against the cached counts, and only fetch the reactors
+                # of emoji whose count changed.
+                # (A reactor swapping for another between scans goes unnoticed.)
+                counts = {str(r): r.count for r in reactions}
+                cached = self._store.get(msg.id)
+                if cached is not None and dict(cached.react_counts()) == counts:
+                    stats['unchanged_msgs'] += 1
+                    stats['reactor_calls_avoided'] += sum(map(reactor_calls, counts.values()))
+                    return False
+                cached_reacts = cached['reacts'] if cached is not None else {}
+
+                # Upserting replaces the whole 'reacts' dict, so deleted reacts
+                # are removed from the cache too.
+                reacts = {}
+                for r in reactions:
+                    emoji = str(r)
+                    if len(cached_reacts.get(emoji, ())) == r.count:
+                        reacts[emoji] = cached_reacts[emoji]
+                        stats['reactor_calls_avoided'] += reactor_calls(r.count)
+                    else:
+                        reacts[emoji] = [user.id for user in await r.users().flatten()]
+                        stats['reactor_calls'] += reactor_calls(r.count)
+                record = {
+                    'id':       msg.id,
+                    'author':   msg.author.id,
+                    'channel':  channel.id,
+                    'datetime': dttos(msg.created_at),
+                    'reacts':   reacts,
+                }
+                self._messages.upsert(record, Message.id == msg.id)
+                self._store.upsert(record)
+                return True
+
+            def reactor_calls(count):
+                """ The number of requests needed to fetch `count` reactors. """
+                return max(1, math.ceil(count / REACTORS_PER_REQUEST))
+
+            def insert_emoji_record(reactions):
+                """ Insert an `Emoji` record into the cache. """
+                Emoji = tinydb.Query()
+                for r in reactions:
+                    record = {}
+                    # type(r) == Union[discord.Emoji, discord.PartialEmoji, str]
+                    if type(r.emoji) == str:
+                        if len(r.emoji) > 2:
+                            logger.warning(f'found over-long unicode emoji {r.emoji}')
+                        # Build an integer representing the unicode code point.
+                        id = 0
+                        for i, c in enumerate(reversed(r.emoji)):
+                            id |= ord(c)
+                            if i < len(r.emoji) - 1:
+                                id <<= 16
+
+                        record['id']        = id
+                        record['name']      = r.emoji
+                        record['custom']    = False
+                    else:
+                        record['id']            = r.emoji.id
+                        record['name']          = r.emoji.name
+                        record['custom']        = True
+                        record['url']           = str(r.emoji.url)
+                        record['discord_str']   = str(r.emoji)
+                        record['created_at']    = dttos(r.emoji.created_at)
+                    self._emoji.upsert(record, Emoji.id == record['id'])
+
+            since_str = "forever ago" if not sentinel_datetime else dttos(sentinel_datetime)
+            logger.info(f'Scanning channel history: {channel.name} since {since_str}')
+
+            # Find all the reacts in the channel since our last sentinel
+            # Maintain a sliding window of the last RESCAN_LAST_N messages
+            # so we can construct a new sentinel.
+            newest_msgs = deque(maxlen=lookback_num)
+            async for msg in channel.history(limit=None, after=sentinel_datetime, oldest_first=True):
+                reactions = msg.reactions
+                # The paging arrows on our own results tables aren't real reactions.
+                if msg.author == guild.me:
+                    reactions = [r for r in reactions if str(r) not in (PREV_PAGE, NEXT_PAGE)]
+
+                # Also revisit cached messages whose reactions were all removed.
+                if reactions or msg.id in self._store:
+                    if await insert_message_record(msg, reactions):
+                        insert_emoji_record(reactions)
+                newest_msgs.append(msg)
+
+            # Select and persist a new sentinel
+            lateness = self._lateness[channel.id]
+            self._lateness_dirty.discard(channel.id)
+            if newest_msgs:
+                nth_newest_datetime = newest_msgs[0].created_at
+                newest_datetime = newest_msgs[-1].created_at
+                sentinel_datetime = min(nth_newest_datetime, newest_datetime - lookback_time)
+                if previous_sentinel is not None:
+                    sentinel_datetime = max(sentinel_datetime, previous_sentinel)
+
+                self._channels.upsert({
+                    'name': channel.name,
+                    'id': channel.id,
+                    'guild': guild.id,
+                    'sentinel_datetime': dttos(sentinel_datetime),
+                    'last_message_id': newest_msgs[-1].id,
+                    'lateness': lateness.to_dict(),
+                }, Channel.id == channel.id)
+                self._sentinels[channel.id] = sentinel_datetime
+            elif channels:
+                # Nothing new (e.g. the newest message was deleted), but remember
+                # that we've seen this far so the channel isn't scanned again on startup.
+                self._channels.update({
+                    'last_message_id': channel.last_message_id,
+                    'lateness': lateness.to_dict(),
+                }, Channel.id == channel.id)
+
+            logger.info(f'{channel.name}: lookback {lookback_num} msgs / {lookback_time}; '
+                        f'{lateness.misses} of {len(lateness)} reaction changes missed '
+                        f'({lateness.miss_rate():.2%})')
+
+            elapsed_time = time.time() - start_time
+            logger.info(f'{channel.name} scan complete in {elapsed_time:.1f}s; '
+                        f'{stats["reactor_calls"]} reactor requests made, '
+                        f'{stats["reactor_calls_avoided"]} avoided')
+            return stats
+
+    def _lookback(self, channel_id):
+        """ Return the (lookback_num, lookback_time) to use for the channel's
+            next sentinel.
+
+            Once enough reaction changes have been observed in the channel, the
+            window covers the LATENESS_QUANTILE of how long after posting its
+            messages' reactions still changed. Until then, the defaults are used.
+        """
+        lateness = self._lateness.get(channel_id)
+        if lateness is None or len(lateness) < LATENESS_MIN_SAMPLES:
+            return DEFAULT_LOOKBACK_NUM, DEFAULT_LOOKBACK_TIME
+
+        window = datetime.timedelta(seconds=lateness.quantile(LATENESS_QUANTILE))
+        return ADAPTIVE_LOOKBACK_NUM, min(max(window, MIN_LOOKBACK_TIME), MAX_LOOKBACK_TIME)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        self._observe_reaction(payload)
 
-        if not channel.permissions_for(ctx.guild.me).read_message_history:
-            logger.warning(f'Bot not permitted to read_message_history in {channel.name}')
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        self._observe_reaction(payload)
+
+    def _observe_reaction(self, payload):
+        """ Record how long after its message was posted a reaction changed.
+
+            Changes to messages from before the channel's sentinel are counted
+            as misses, since no rescan would pick them up.
+            These stats are persisted periodically (see `_flush_lateness`),
+            and with the channel whenever it's rescanned.
+        """
+        if payload.guild_id is None or payload.user_id == self.bot.user.id:
             return
+        # Flipping the pages of a results table isn't a real reaction.
+        # (Taking the arrow back off also fires a removal on the user's behalf.)
+        if str(payload.emoji) in (PREV_PAGE, NEXT_PAGE):
+            return
+        created_at = discord.utils.snowflake_time(payload.message_id)
+        lateness = datetime.datetime.utcnow() - created_at
+
+        sentinel = self._sentinels.get(payload.channel_id)
+        missed = sentinel is not None and created_at < sentinel
+        if missed:
+            logger.info(f'Missed reaction change on message {payload.message_id}, '
+                        f'{lateness} after it was posted')
+        self._lateness[payload.channel_id].add(lateness.total_seconds(), missed=missed)
+        self._lateness_dirty.add(payload.channel_id)
+
+    @tasks.loop(minutes=LATENESS_FLUSH_MINUTES)
+    async def _flush_lateness_loop(self):
+        self._flush_lateness()
+
+    def _flush_lateness(self):
+        """ Write the lateness stats of every channel that has gathered new
+            samples since they were last saved, in a single update.
+
+            Channels that have never been scanned have no record to save to;
+            their stats are kept in memory until their first rescan.
+        """
+        if not self._lateness_dirty:
+            return
+        dirty, self._lateness_dirty = self._lateness_dirty, set()
 
-        # Find the last sentinel, if it exists
+        def set_lateness(doc):
+            doc['lateness'] = self._lateness[doc['id']].to_dict()
         Channel = tinydb.Query()
-        sentinel_datetime = None
-        if channels := self._channels.search(Channel.id == channel.id):
-            if len(channels) != 1:
-                logger.warning(f"Search for channel id {channel.id} expected 1 channel; yielded {channels}")
-                return
-            sentinel_datetime = stodt(channels[0]['sentinel_datetime'])
-
-        if force_sentinel is not None:
-            sentinel_datetime = force_sentinel
-
-        async def insert_message_record(msg):
-            """ Insert a `Message` record into the cache. """
-            Message = tinydb.Query()
-            self._messages.upsert({
-                'id':       msg.id,
-                'author':   msg.author.id,
-                'channel':  channel.id,
-                'datetime': dttos(msg.created_at),
-            }, Message.id == msg.id)
-
-            # Forcibly overwrite reacts to ensure deleted reacts are removed from cache.
-            reacts = {str(r): [user.id for user in await r.users().flatten()] for r in msg.reactions}
-            self._messages.update(dbops.set('reacts', reacts), Message.id == msg.id)
-
-        def insert_emoji_record(msg):
-            """ Insert an `Emoji` record into the cache. """
-            Emoji = tinydb.Query()
-            for r in msg.reactions:
-                record = {}
-                # type(r) == Union[discord.Emoji, discord.PartialEmoji, str]
-                if type(r.emoji) == str:
-                    if len(r.emoji) > 2:
-                        logger.warning(f'found over-long unicode emoji {r.emoji}')
-                    # Build an integer representing the unicode code point.
-                    id = 0
-                    for i, c in enumerate(reversed(r.emoji)):
-                        id |= ord(c)
-                        if i < len(r.emoji) - 1:
-                            id <<= 16
-
-                    record['id']        = id
-                    record['name']      = r.emoji
-                    record['custom']    = False
-                else:
-                    record['id']            = r.emoji.id
-                    record['name']          = r.emoji.name
-                    record['custom']        = True
-                    record['url']           = str(r.emoji.url)
-                    record['discord_str']   = str(r.emoji)
-                    record['created_at']    = dttos(r.emoji.created_at)
-                self._emoji.upsert(record, Emoji.id == record['id'])
-
-        since_str = "forever ago" if not sentinel_datetime else dttos(sentinel_datetime)
-        logger.info(f'Scanning channel history: {channel.name} since {since_str}')
-
-        # Find all the reacts in the channel since our last sentinel
-        # Maintain a sliding window of the last RESCAN_LAST_N messages
-        # so we can construct a new sentinel.
-        newest_msgs = deque(maxlen=lookback_num)
-        async for msg in channel.history(limit=None, after=sentinel_datetime, oldest_first=True):
-            if msg.reactions:
-                insert_emoji_record(msg)
-                await insert_message_record(msg)
-            newest_msgs.append(msg)
-
-        # Select and persist a new sentinel
-        if newest_msgs:
-            nth_newest_datetime = newest_msgs[0].created_at
-            newest_datetime = newest_msgs[-1].created_at
-            sentinel_datetime = min(nth_newest_datetime, newest_datetime - lookback_time)
-
-            self._channels.upsert({
-                'name': channel.name,
-                'id': channel.id,
-                'guild': ctx.guild.id,
-                'sentinel_datetime': dttos(sentinel_datetime),
-            }, Channel.id == channel.id)
-
-        elapsed_time = time.time() - start_time
-        logger.info(f'{channel.name} scan complete in {elapsed_time:.1f}s')
+        self._channels.update(set_lateness, Channel.id.one_of(list(dirty)))
+        logger.info(f'Saved lateness stats for {len(dirty)} channels')
 
     ###########################################################
     ##                     Querying
@@ -315,7 +709,7 @@ class Cache(commands.Cog):
 
     def query_by_author(self, ctx, author: str):
         """ Return a tinydb query for messages sent by a specific author. """
-        user_ids = [u.id for u in self.get_users_by_name(ctx, author)]
+        user_ids = [u.id for u in self.get_members_by_name(ctx, author)]
         return tinydb.Query().author.test(lambda uid: uid in user_ids)
 
     def query_by_reactor(self, ctx, reactor: str):
@@ -326,7 +720,7 @@ class Cache(commands.Cog):
             and may also have other unrelated reactions.
             This might not be the desired behavior for this function long-term.
         """
-        user_ids = [u.id for u in self.get_users_by_name(ctx, reactor)]
+        user_ids = [u.id for u in self.get_members_by_name(ctx, reactor)]
         def test_reactor(reacts):
             for user_id in user_ids:
                 if any([user_id in reactors for reactors in reacts.values()]):
@@ -349,19 +743,32 @@ class Cache(commands.Cog):
             return any([react in r for r in reacts])
         return tinydb.Query().reacts.test(test_react)
 
-    def query_by_before(self, ctx, before_date: datetime.datetime):
+    def query_by_before(self, ctx, before_date: str):
         """ Return a tinydb query for messages sent before a specific date. """
-        test_before = lambda dt_str: stodt(dt_str) < stodt(before_date, fmt=YMD_FORMAT)
-        return tinydb.Query().datetime.test(test_before)
+        before = dt_to_micros(stodt(before_date, fmt=YMD_FORMAT))
+        return tinydb.Query().timestamp < before
 
-    def query_by_after(self, ctx, after_date: datetime.datetime):
+    def query_by_after(self, ctx, after_date: str):
         """ Return a tinydb query for messages sent after a specific date. """
-        test_after = lambda dt_str: stodt(dt_str) > stodt(after_date, fmt=YMD_FORMAT)
-        return tinydb.Query().datetime.test(test_after)
+        after = dt_to_micros(stodt(after_date, fmt=YMD_FORMAT))
+        return tinydb.Query().timestamp > after
 
-    def query_message_cache(self, ctx, *args):
+    async def query_message_cache(self, ctx, *args, trace=None):
         """ Search the message cache with the given directives,
-            and return a list of messages that match. """
+            and return a list of messages that match.
+
+            The messages are returned as read-only MessageRecord views, which
+            support the same keys as the cache records.
+
+            The scan periodically yields to the event loop, so a large query
+            doesn't stall the bot. Messages cached meanwhile aren't included.
+
+            If a QueryTrace is provided, the chosen plan, the number of messages
+            examined and matched by each filter, and the time spent in each
+            stage are recorded to it.
+        """
+        if trace is None:
+            trace = QueryTrace()
 
         directives = {
             'in': self.query_by_channel,
@@ -372,7 +779,7 @@ class Cache(commands.Cog):
             'after': self.query_by_after,
         }
 
-        queries = []
+        filters = []
         for arg in args:
             cmd_pcs = arg.split(":", 1)
             if len(cmd_pcs) != 2:
@@ -389,16 +796,33 @@ class Cache(commands.Cog):
             # one subquery for each val, and merge them together with the | operator.
             # (i.e. match any message that satisfies just one predicate)
             vals = val.split(",")
-            subqueries = [query_func(ctx, v) for v in vals]
+            with trace.stage(f"{DIRECTIVE_STAGES.get(cmd, 'parse')} ({arg})"):
+                subqueries = [query_func(ctx, v) for v in vals]
             query = functools.reduce(operator.or_, subqueries)
-            queries.append(query)
-
-        # Combine queries with & operator to match only those that satisfy all queries.
-        # If queries is empty, noop() acts as the default, matching all messages.
-        logger.info(f"querying with: {queries}")
-        merged_query = functools.reduce(operator.and_, queries, tinydb.Query().noop())
-
-        return self._messages.search(merged_query)
+            filters.append((cmd, arg, query))
+
+        # Messages must satisfy all of the filters, so apply the cheapest first.
+        # If there are no filters, every message matches.
+        filters.sort(key=lambda f: DIRECTIVE_COSTS[f[0]])
+        logger.info(f"querying with: {[query for _, _, query in filters]}")
+        trace.plan = [arg for _, arg, _ in filters]
+        trace.filters = [[arg, 0, 0] for _, arg, _ in filters]
+        trace.rows = len(self._store)
+
+        matches = []
+        with trace.stage('filter scan'):
+            for i, msg in enumerate(self._store):
+                if i % SCAN_BATCH_SIZE == 0:
+                    with trace.aside('yielded to other tasks'):
+                        await asyncio.sleep(0)
+                for (_, _, query), counts in zip(filters, trace.filters):
+                    counts[1] += 1
+                    if not query(msg):
+                        break
+                    counts[2] += 1
+                else:
+                    matches.append(msg)
+        return matches
 
 
 def setup(bot):
@@ -0,0 +1,101 @@
+from discord.ext import commands
+
+import asyncio
+from collections import defaultdict
+import contextlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+###########################################################
+##                     SingleFlight
+###########################################################
+
+class SingleFlight():
+    """ Coalesces concurrent calls that share a key into a single computation.
+
+        While a computation for a key is in flight, further calls with the same
+        key wait for (and share) its result rather than starting their own.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def join(self, key):
+        """ Return an awaitable for the in-flight computation with the given key,
+            or None if there isn't one. """
+        fut = self._inflight.get(key)
+        return None if fut is None else asyncio.shield(fut)
+
+    async def do(self, key, coro_fn):
+        """ Return the result of `await coro_fn()`, sharing it with any other
+            concurrent callers using the same key.
+
+            Cancelling one caller doesn't cancel the shared computation.
+        """
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(coro_fn())
+            self._inflight[key] = fut
+
+            def forget(f):
+                if self._inflight.get(key) is f:
+                    del self._inflight[key]
+            fut.add_done_callback(forget)
+        else:
+            logger.info(f'Joining in-flight computation for {key}')
+        return await asyncio.shield(fut)
+
+###########################################################
+##                   AdmissionControl
+###########################################################
+
+class Overloaded(commands.CommandError):
+    """ Raised when a heavy command can't be admitted right now. """
+    pass
+
+class AdmissionControl():
+    """ Caps how many heavy commands run at once.
+
+        At most `max_running` commands run concurrently, and at most
+        `max_waiting` more may queue up behind them; beyond that, commands are
+        turned away. Each user may only have `per_user` commands running or
+        queued at a time, so one user can't crowd everyone else out.
+    """
+
+    def __init__(self, max_running=2, max_waiting=8, per_user=2):
+        self.max_waiting = max_waiting
+        self.per_user = per_user
+        self._sem = asyncio.Semaphore(max_running)
+        self._waiting = 0
+        self._per_user = defaultdict(int)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id):
+        """ Wait for a slot to run a heavy command on behalf of the user.
+
+            Raises:
+                Overloaded, if the user or the queue is already at its limit.
+        """
+        if self._per_user.get(user_id, 0) >= self.per_user:
+            raise Overloaded("You've already got too many heavy commands going. "
+                             "Give them a moment to finish!")
+        if self._sem.locked() and self._waiting >= self.max_waiting:
+            raise Overloaded("I'm pretty busy right now. Try again in a bit!")
+
+        self._per_user[user_id] += 1
+        try:
+            self._waiting += 1
+            try:
+                await self._sem.acquire()
+            finally:
+                self._waiting -= 1
+
+            try:
+                yield
+            finally:
+                self._sem.release()
+        finally:
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
@@ -3,10 +3,63 @@ from discord.ext import commands
 
 import asyncio
 from collections import defaultdict
+import heapq
 import logging
+import math
+import operator
+import time
+
+from .concurrency import SingleFlight
+from .paging import PREV_PAGE, NEXT_PAGE
+from .querytrace import QueryTrace
 
 logger = logging.getLogger(__name__)
 
+###########################################################
+##                Constants and Helpers
+###########################################################
+
+# Discord rejects embeds with more than 25 fields.
+PAGE_SIZE = 24
+
+# How long (in seconds) a sent result table can still be paged through.
+SESSION_TTL = 10 * 60
+
+class ResultSession():
+    """ The aggregated results of one hist query, kept around for a short while
+        so that later pages can be rendered without re-running the query. """
+
+    def __init__(self, results, page_size=PAGE_SIZE, ttl=SESSION_TTL):
+        """ Params:
+                - results, dict: {emoji-str: count}
+                - page_size: The number of emoji to show per page.
+                - ttl: Seconds until this session expires.
+        """
+        self.results = results
+        self.page_size = page_size
+        self.page = 0
+        self.msg = None # The discord.Message displaying these results, once sent.
+        self.expires_at = time.monotonic() + ttl
+
+    @property
+    def num_pages(self):
+        return max(1, math.ceil(len(self.results) / self.page_size))
+
+    def expired(self):
+        return time.monotonic() > self.expires_at
+
+    def top(self, k):
+        """ Return the `k` most frequent (emoji, count) pairs, most frequent first. """
+        return heapq.nlargest(k, self.results.items(), key=operator.itemgetter(1))
+
+    def page_items(self, page=None):
+        """ Return the (emoji, count) pairs shown on the given page (default: current). """
+        if page is None:
+            page = self.page
+        start = page * self.page_size
+        return self.top(start + self.page_size)[start:]
+
+
 ###########################################################
 ##                     EmojiStats
 ###########################################################
@@ -15,6 +68,12 @@ class EmojiStats(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+        # Maps the id of a sent results message to its ResultSession.
+        self._sessions = {}
+
+        # In-flight hist computations, keyed by guild and query.
+        self._hist_flights = SingleFlight()
+
     @commands.group()
     async def emoji(self, ctx):
         if ctx.invoked_subcommand is None:
@@ -56,10 +115,59 @@ Examples:
             ctx.send(help_msg)
             return
 
-        msgs = self.bot.cache.query_message_cache(ctx, *args)
-        collated_msgs = self.collate_messages(ctx, msgs, *args)
+        # Identical queries running at the same time share one computation.
+        # Only the caller who starts a computation is subject to admission
+        # control; joining one is free. (A rejected caller never starts one,
+        # so nobody else inherits their rejection.)
+        async def compute():
+            msgs = await self.bot.cache.query_message_cache(ctx, *args)
+            return self.collate_messages(ctx, msgs, *args)
+        key = (ctx.guild.id, self.normalize_query(args))
+        if (running := self._hist_flights.join(key)) is not None:
+            collated_msgs = await running
+        else:
+            async with self.bot.admission.admit(ctx.author.id):
+                collated_msgs = await self._hist_flights.do(key, compute)
+
         await self.display_emoji_stats(ctx, collated_msgs, *args)
 
+    def normalize_query(self, args):
+        """ Return a canonical form of the given query directives, so that
+            equivalent queries compare equal.
+
+            Directives are ANDed together and comma-separated values are ORed,
+            so the order of neither matters.
+            e.g. ('after:2020-01-01', 'in:spam,general')
+              -> ('after:2020-01-01', 'in:general,spam')
+        """
+        normalized = []
+        for arg in args:
+            cmd, sep, val = arg.partition(":")
+            if sep:
+                arg = f'{cmd}:{",".join(sorted(val.split(",")))}'
+            normalized.append(arg)
+        return tuple(sorted(normalized))
+
+    @emoji.command(aliases=['profile'])
+    async def explain(self, ctx, *args):
+        """ Run a hist query with tracing, and report the chosen plan, how many
+            messages each filter examined and matched, and the time per stage.
+
+            Params:
+                args: the same directives accepted by `hist`.
+        """
+        trace = QueryTrace()
+        async with self.bot.admission.admit(ctx.author.id):
+            msgs = await self.bot.cache.query_message_cache(ctx, *args, trace=trace)
+            with trace.stage('collation'):
+                collated_msgs = self.collate_messages(ctx, msgs, *args)
+        with trace.stage('send'):
+            await self.display_emoji_stats(ctx, collated_msgs, *args)
+
+        report = trace.report()
+        logger.info(f'explain {args}:\n{report}')
+        await ctx.send(f'```\n{report}\n```')
+
     def collate_messages(self, ctx, messages, *args, strict_matching=False):
         """ Transform the provided list of messages into a clean set of results that
             can be easily displayed, per the format requested by args.
@@ -82,12 +190,12 @@ Examples:
         #       mapping emoji to occurrence counts.
         #       e.g. Map users to their most frequent reactions.
 
-        # messages looks like this:
-        # [ {..., 'reacts': {'<:poggers:12345>': [uid, uid, uid], '👍': [uid, uid, uid]}}, ... ]
+        # messages is a list of MessageRecords, whose react_counts() yield e.g.
+        # [('<:poggers:12345>', 3), ('👍', 3)]
         collated = defaultdict(lambda: 0)
         for msg in messages:
-            for react, reactors in msg['reacts'].items():
-                collated[react] += len(reactors)
+            for react, count in msg.react_counts():
+                collated[react] += count
         return collated
 
     async def display_emoji_stats(self, ctx, results, *args):
@@ -101,11 +209,29 @@ Examples:
         await self.send_emoji_table(ctx, results)
 
     async def send_emoji_table(self, ctx, emojis):
-        """ Send an embed table mapping each emoji to its number of occurrences.
+        """ Send an embed table mapping the most frequent emoji to their number
+            of occurrences, one page at a time.
+
+            If the results don't fit on a single page, the message is given
+            PREV_PAGE/NEXT_PAGE reactions, which can be used to flip through
+            the remaining pages until the session expires.
+
             Params:
                 - emoji, dict:
                     {emoji-str: 3}
         """
+        self._expire_sessions()
+
+        session = ResultSession(emojis)
+        msg = await ctx.send(embed=self.emoji_table_embed(session))
+        if session.num_pages > 1:
+            session.msg = msg
+            self._sessions[msg.id] = session
+            await msg.add_reaction(PREV_PAGE)
+            await msg.add_reaction(NEXT_PAGE)
+
+    def emoji_table_embed(self, session):
+        """ Build the embed for the current page of the given session. """
 
         # TODO: Make this embed less awful and sad.
         #       Make the Embed table a little prettier, give more information
@@ -113,19 +239,47 @@ Examples:
         #       were searched, what time the info is up-to-date as of, ...
 
         embed=discord.Embed(title=f"Results", color=0xb14e4e)
+        for emoji_str, count in session.page_items():
+            embed.add_field(name=emoji_str, value=str(count))
+        if session.num_pages > 1:
+            embed.set_footer(text=f"Page {session.page + 1}/{session.num_pages}")
+        return embed
 
-        # TODO: This is really jank, don't use a list of tuples.
-        #       Use some sort of dict.items() magic instead, or some magic comprehension?
-        # Convert dict to a list of tuples
-        counts = list(emojis.items())
+    def _expire_sessions(self):
+        """ Forget about any result sessions that can no longer be paged. """
+        expired = [msg_id for msg_id, s in self._sessions.items() if s.expired()]
+        for msg_id in expired:
+            del self._sessions[msg_id]
 
-        # And sort it by descending number of occurences...
-        counts.sort(key=lambda x: x[1], reverse=True)
-        for emoji_str, count in counts:
-            embed.add_field(name=emoji_str, value=str(count))
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        """ Flip the page of a results table when someone reacts to it. """
+        if payload.user_id == self.bot.user.id:
+            return
+        session = self._sessions.get(payload.message_id)
+        if session is None:
+            return
+        if session.expired():
+            del self._sessions[payload.message_id]
+            return
+
+        emoji_str = str(payload.emoji)
+        if emoji_str == PREV_PAGE:
+            step = -1
+        elif emoji_str == NEXT_PAGE:
+            step = 1
+        else:
+            return
+        session.page = (session.page + step) % session.num_pages
 
-        await ctx.send(embed=embed)
+        msg = session.msg
+        await msg.edit(embed=self.emoji_table_embed(session))
 
+        # Take the reaction back off, so the same arrow can be pressed again.
+        try:
+            await msg.remove_reaction(payload.emoji, discord.Object(payload.user_id))
+        except discord.Forbidden:
+            logger.debug(f'Not permitted to remove reactions in {msg.channel.name}')
 
     # please clap
     # assign a random react to the message
@@ -0,0 +1,90 @@
+import json
+
+import logging
+logger = logging.getLogger(__name__)
+
+# How many characters to read from the file at a time.
+READ_SIZE = 1 << 16
+
+###########################################################
+##                  Streaming reader
+###########################################################
+
+class _Reader():
+    """ A buffered reader that decodes one JSON value at a time from a file. """
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """ Read more of the file into the buffer. Returns False at EOF. """
+        chunk = self.f.read(READ_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Return the next non-whitespace character, without consuming it. """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """ Consume the next character, which must be one of `chars`. """
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f'Expected one of {chars!r} at offset {self.pos}, found {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self):
+        """ Decode and consume the next JSON value. """
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number running up to the end of the buffer may be cut short.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def stream_tables(path):
+    """ Yield (table, record) pairs from a TinyDB JSON file, one at a time,
+        without ever holding more than one record in memory. """
+    with open(path, encoding='utf-8') as f:
+        r = _Reader(f)
+        if r.peek() == '':
+            return # TinyDB leaves new databases empty until the first write
+        r.expect('{')
+        if r.peek() == '}':
+            return
+        while True:
+            table = r.value()
+            r.expect(':')
+            r.expect('{')
+            if r.peek() != '}':
+                while True:
+                    r.value() # doc_id
+                    r.expect(':')
+                    yield table, r.value()
+                    if r.expect(',}') == '}':
+                        break
+            else:
+                r.expect('}')
+            if r.expect(',}') == '}':
+                return
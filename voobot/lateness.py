@@ -0,0 +1,55 @@
+import logging
+logger = logging.getLogger(__name__)
+
+###########################################################
+##                  LatenessHistogram
+###########################################################
+
+class LatenessHistogram():
+    """ A log-scale histogram of how long after a message was posted its
+        reactions still change (its "lateness"), for a single channel.
+
+        Bucket 0 counts lateness under 1 second, and bucket i > 0 counts
+        lateness in [2**(i-1), 2**i) seconds. The last bucket also counts
+        anything longer.
+
+        Alongside, it counts "misses": reaction changes on messages older than
+        the channel's sentinel, which a rescan would never pick up.
+    """
+
+    NUM_BUCKETS = 27    # 2**26 seconds is a little over two years
+
+    def __init__(self, counts=None, misses=0):
+        self.counts = list(counts) if counts else [0] * self.NUM_BUCKETS
+        self.misses = misses
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def add(self, seconds, missed=False):
+        """ Record a reaction change `seconds` after its message was posted. """
+        bucket = min(max(0, int(seconds)).bit_length(), self.NUM_BUCKETS - 1)
+        self.counts[bucket] += 1
+        if missed:
+            self.misses += 1
+
+    def quantile(self, q):
+        """ Return an upper bound, in seconds, on the q'th quantile of lateness. """
+        target = q * len(self)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return 2 ** bucket
+        return 0
+
+    def miss_rate(self):
+        """ Return the fraction of recorded changes which were misses. """
+        return self.misses / len(self) if len(self) else 0.0
+
+    def to_dict(self):
+        return {'counts': self.counts, 'misses': self.misses}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get('counts'), d.get('misses', 0))
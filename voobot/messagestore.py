@@ -0,0 +1,260 @@
+from array import array
+import datetime
+
+import logging
+logger = logging.getLogger(__name__)
+
+###########################################################
+##                Constants and Helpers
+###########################################################
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+def dt_to_micros(dt):
+    """ Convert a (naive, UTC) datetime to microseconds since the epoch. """
+    return (dt - EPOCH) // MICROSECOND
+
+def _to_micros(s):
+    """ Convert a cached datetime string to microseconds since the epoch. """
+    return dt_to_micros(datetime.datetime.strptime(s, DATETIME_FORMAT))
+
+def _from_micros(ts):
+    """ Convert microseconds since the epoch back to a cached datetime string. """
+    return (EPOCH + ts * MICROSECOND).strftime(DATETIME_FORMAT)
+
+###########################################################
+##                   MessageStore
+###########################################################
+
+class _Columns():
+    """ One generation of a MessageStore's arrays.
+
+        Rows are only ever appended, never modified, so a MessageRecord
+        holding on to a generation stays valid after the store moves on.
+    """
+    __slots__ = ('ids', 'authors', 'channels', 'timestamps', 'react_start',
+                 'react_len', 'react_emoji', 'reactor_start', 'reactor_len',
+                 'reactors', 'emoji')
+
+    def __init__(self, emoji):
+        # One entry per message row
+        self.ids = array('Q')
+        self.authors = array('Q')
+        self.channels = array('Q')
+        self.timestamps = array('q')        # Microseconds since the epoch (UTC)
+        self.react_start = array('I')       # Index of the first react of this row
+        self.react_len = array('H')
+
+        # One entry per (message, emoji) pair
+        self.react_emoji = array('I')       # Index into self.emoji
+        self.reactor_start = array('I')     # Index of the first reactor of this react
+        self.reactor_len = array('I')
+
+        # One entry per reaction
+        self.reactors = array('Q')
+
+        # Interned emoji strings, shared between generations (append-only)
+        self.emoji = emoji
+
+    def react_range(self, row):
+        start = self.react_start[row]
+        return range(start, start + self.react_len[row])
+
+    def react_counts(self, row):
+        """ Yield (emoji, count) for each react on the message in the given row. """
+        for r in self.react_range(row):
+            yield self.emoji[self.react_emoji[r]], self.reactor_len[r]
+
+    def reacts(self, row):
+        """ Return the reacts dict of the message in the given row. """
+        reacts = {}
+        for r in self.react_range(row):
+            start = self.reactor_start[r]
+            reacts[self.emoji[self.react_emoji[r]]] = \
+                self.reactors[start:start + self.reactor_len[r]].tolist()
+        return reacts
+
+    def nbytes(self):
+        """ Return the approximate number of bytes used by the arrays. """
+        columns = [self.ids, self.authors, self.channels, self.timestamps,
+                   self.react_start, self.react_len, self.react_emoji,
+                   self.reactor_start, self.reactor_len, self.reactors]
+        return sum(a.buffer_info()[1] * a.itemsize for a in columns)
+
+
+class MessageStore():
+    """
+    A compact in-memory copy of the message cache.
+
+    Rather than holding one dict per message (with its own string keys,
+    datetime string and dict of reactor lists), messages are stored as parallel
+    `array` columns, one entry per message. Each message's reacts are a slice
+    of the per-react columns, and each react's reactors are a slice of one flat
+    array of user ids. Emoji strings are interned, and referred to by index.
+
+    Records are exposed through MessageRecord, a read-only dict-like view, so
+    existing tinydb queries and code written against cache records work on it
+    unchanged.
+
+    Updating a message appends a fresh row and abandons the old one; the
+    arrays are compacted into a new generation once abandoned rows outnumber
+    live ones. Records (and iterators) keep reading from the generation they
+    were created from, so they remain valid while the store is written to.
+    """
+
+    def __init__(self):
+        self._emoji_index = {}
+        self._cols = _Columns([])
+
+        # Maps message id -> live row. Iterates in order of first insertion.
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        # Snapshot the rows, so writes during iteration don't affect it.
+        cols, rows = self._cols, list(self._rows.values())
+        for row in rows:
+            yield MessageRecord(cols, row)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._rows
+
+    def get(self, msg_id):
+        """ Return the MessageRecord for the message with the given id, or None. """
+        row = self._rows.get(msg_id)
+        return None if row is None else MessageRecord(self._cols, row)
+
+    def search(self, query):
+        """ Return a list of the MessageRecords matching the given tinydb query. """
+        return [record for record in self if query(record)]
+
+    def extend(self, records):
+        """ Add (or replace) each of the given message records. """
+        for record in records:
+            self.upsert(record)
+
+    def upsert(self, record):
+        """ Add a message record to the store, replacing any with the same id.
+
+            Params:
+                - record, dict: a message cache record, e.g.
+                    {'id': 1, 'author': 2, 'channel': 3,
+                     'datetime': '2021-01-01 00:00:00.000000',
+                     'reacts': {'👍': [uid, uid]}}
+        """
+        cols = self._cols
+        reacts = record.get('reacts', {})
+
+        self._rows[record['id']] = len(cols.ids)
+        cols.ids.append(record['id'])
+        cols.authors.append(record['author'])
+        cols.channels.append(record['channel'])
+        cols.timestamps.append(_to_micros(record['datetime']))
+        cols.react_start.append(len(cols.react_emoji))
+        cols.react_len.append(len(reacts))
+
+        for emoji, reactors in reacts.items():
+            cols.react_emoji.append(self._intern(emoji))
+            cols.reactor_start.append(len(cols.reactors))
+            cols.reactor_len.append(len(reactors))
+            cols.reactors.extend(reactors)
+
+        if len(cols.ids) > 2 * len(self._rows) + 1024:
+            self.compact()
+
+    def _intern(self, emoji):
+        """ Return the index of the given emoji string, adding it if necessary. """
+        i = self._emoji_index.get(emoji)
+        if i is None:
+            i = self._emoji_index[emoji] = len(self._cols.emoji)
+            self._cols.emoji.append(emoji)
+        return i
+
+    def compact(self):
+        """ Copy the live rows into a new generation of arrays,
+            dropping rows that have been replaced. """
+        old, new = self._cols, _Columns(self._cols.emoji)
+        rows = {}
+
+        for msg_id, row in self._rows.items():
+            rows[msg_id] = len(new.ids)
+            new.ids.append(msg_id)
+            new.authors.append(old.authors[row])
+            new.channels.append(old.channels[row])
+            new.timestamps.append(old.timestamps[row])
+            new.react_start.append(len(new.react_emoji))
+            new.react_len.append(old.react_len[row])
+            for r in old.react_range(row):
+                start, n = old.reactor_start[r], old.reactor_len[r]
+                new.react_emoji.append(old.react_emoji[r])
+                new.reactor_start.append(len(new.reactors))
+                new.reactor_len.append(n)
+                new.reactors.extend(old.reactors[start:start + n])
+
+        self._cols, self._rows = new, rows
+
+    def nbytes(self):
+        """ Return the approximate number of bytes used by the store's arrays. """
+        return self._cols.nbytes()
+
+
+class MessageRecord():
+    """ A read-only, dict-like view of a single message in a MessageStore.
+
+        Supports the keys of a message cache record:
+        'id', 'author', 'channel', 'datetime' and 'reacts'.
+
+        It also supports 'timestamp': the message's datetime in microseconds
+        since the epoch, which is much cheaper to filter on than 'datetime'.
+    """
+    __slots__ = ('_cols', '_row')
+
+    KEYS = ('id', 'author', 'channel', 'datetime', 'reacts')
+
+    def __init__(self, cols, row):
+        self._cols = cols
+        self._row = row
+
+    def __getitem__(self, key):
+        cols, row = self._cols, self._row
+        if key == 'id':
+            return cols.ids[row]
+        if key == 'author':
+            return cols.authors[row]
+        if key == 'channel':
+            return cols.channels[row]
+        if key == 'timestamp':
+            return cols.timestamps[row]
+        if key == 'datetime':
+            return _from_micros(cols.timestamps[row])
+        if key == 'reacts':
+            return cols.reacts(row)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def __repr__(self):
+        return f'MessageRecord({self.to_dict()!r})'
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.KEYS
+
+    def to_dict(self):
+        return {key: self[key] for key in self.KEYS}
+
+    def react_counts(self):
+        """ Yield (emoji, count) for each react on this message,
+            without building the reactor lists. """
+        return self._cols.react_counts(self._row)
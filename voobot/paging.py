@@ -0,0 +1,8 @@
+""" Reactions used as controls for flipping through paged result tables.
+
+    These are shared by the cogs that send paged tables and those that need
+    to tell the controls apart from real reactions.
+"""
+
+PREV_PAGE = "◀"
+NEXT_PAGE = "▶"
@@ -0,0 +1,75 @@
+import contextlib
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+###########################################################
+##                     QueryTrace
+###########################################################
+
+class QueryTrace():
+    """ Records the plan, per-filter row counts, and per-stage wall times
+        of a single message cache query, for `+emoji explain`. """
+
+    def __init__(self):
+        self.plan = []      # Labels of the filters, in the order they're applied
+        self.filters = []   # [label, rows examined, rows matched] per filter
+        self.stages = []    # (name, seconds) per stage, in the order they ran
+        self.rows = 0       # Rows in the message cache when scanned
+        self._excluded = [] # Time to exclude from each currently open stage
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time the enclosed block as a stage of the query. """
+        start = time.perf_counter()
+        self._excluded.append(0.0)
+        try:
+            yield
+        finally:
+            excluded = self._excluded.pop()
+            self.stages.append((name, time.perf_counter() - start - excluded))
+
+    @contextlib.contextmanager
+    def aside(self, name):
+        """ Time the enclosed block under its own stage, rather than as part of
+            the enclosing one (e.g. time spent yielded to other tasks).
+            Repeated blocks with the same name add up into one stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if self._excluded:
+                self._excluded[-1] += elapsed
+            for i, (stage_name, seconds) in enumerate(self.stages):
+                if stage_name == name:
+                    self.stages[i] = (name, seconds + elapsed)
+                    break
+            else:
+                self.stages.append((name, elapsed))
+
+    def report(self):
+        """ Return a plain text summary of the trace. """
+        lines = [f'Plan: scan {self.rows} cached messages']
+        if not self.plan:
+            lines.append('  (no filters; match everything)')
+        for i, label in enumerate(self.plan, 1):
+            lines.append(f'  {i}. {label}')
+
+        if self.filters:
+            width = max(len(label) for label, _, _ in self.filters)
+            lines.append('')
+            lines.append(f'{"Filter":{width + 2}s} {"examined":>9s} {"matched":>9s}')
+            for label, examined, matched in self.filters:
+                lines.append(f'  {label:{width}s} {examined:9d} {matched:9d}')
+
+        width = max([len(name) for name, _ in self.stages] + [len('total')])
+        lines.append('')
+        lines.append('Stages:')
+        for name, seconds in self.stages:
+            lines.append(f'  {name:{width}s} {seconds * 1000:9.1f} ms')
+        total = sum(seconds for _, seconds in self.stages)
+        lines.append(f'  {"total":{width}s} {total * 1000:9.1f} ms')
+        return '\n'.join(lines)
@@ -10,6 +10,7 @@ import asyncio
 import logging
 logging.basicConfig(level=logging.INFO)
 
+from .concurrency import AdmissionControl, Overloaded
 from .progressbar import ProgressBar
 
 logger = logging.getLogger(__name__)
@@ -21,6 +22,10 @@ class VooBot(commands.Bot):
         intents = discord.Intents.default()
         intents.members = True
         super().__init__(command_prefix, intents=intents)
+
+        # Shared by all of the expensive commands (queries, rescans, ...)
+        self.admission = AdmissionControl()
+
         self.register_cogs()
 
     def register_cogs(self):
@@ -32,6 +37,18 @@ class VooBot(commands.Bot):
     def progress_bar(self, msg, **kwargs):
         return ProgressBar(self, msg, **kwargs)
 
+    async def close(self):
+        # Unload the cogs first, so they get a chance to save their state.
+        for extension in list(self.extensions):
+            self.unload_extension(extension)
+        await super().close()
+
+    async def on_command_error(self, ctx, error):
+        if isinstance(error, Overloaded):
+            await ctx.send(str(error))
+            return
+        await super().on_command_error(ctx, error)
+
 """
     @self.client.event
     async def on_ready():